@@ -1,12 +1,180 @@
 import streamlit as st
 import pandas as pd
-import math
+import numpy as np
 from io import StringIO
-from collections import defaultdict
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the kernel still runs as plain Python
+    def njit(*args, **kwargs):
+        def wrap(func):
+            return func
+        return wrap
 
 st.set_page_config(layout="wide")
 st.title("🚀 EVE Ship Courier Contract splitter")
 
+
+@st.cache_data
+def parse_tsv(tsv):
+    # m³ and ISK are exact integers in EVE; keep them int64 end-to-end
+    kwargs = dict(sep="\t", usecols=["Type", "Count", "Volume", "Value"],
+                  dtype={"Count": np.int64, "Volume": np.int64, "Value": np.int64})
+    try:
+        df = pd.read_csv(StringIO(tsv), engine="pyarrow", **kwargs)
+    except ImportError:  # pyarrow is optional; the C engine parses the same spec
+        df = pd.read_csv(StringIO(tsv), engine="c", **kwargs)
+    # Categorical types make every downstream groupby hash int codes, not strings
+    df["Type"] = df["Type"].astype("category")
+    return df
+
+
+@st.cache_data
+def expand_stacks(tsv, volume_limit, value_limit):
+    """Split stacks so no chunk exceeds the volume limit or 50% of the ISK limit."""
+    df = parse_tsv(tsv)
+    # Hangar dumps list the same ship on many lines; merge before splitting
+    df = df.groupby(["Type", "Volume", "Value"], as_index=False, sort=False, observed=True)["Count"].sum()
+    max_stack_value = value_limit // 2
+    counts = df["Count"].to_numpy(np.int64)
+    vols = df["Volume"].to_numpy(np.int64)
+    vals = df["Value"].to_numpy(np.int64)
+
+    chunk_size = np.maximum(1, np.minimum(max_stack_value // vals, volume_limit // vols))
+    splits = -(-counts // chunk_size)
+
+    if splits.sum() == 0:  # header-only paste, or every Count is zero
+        empty = np.zeros(0, np.int64)
+        return pd.DataFrame({
+            "Type": pd.Categorical.from_codes(empty, dtype=df["Type"].dtype),
+            "Count": empty,
+            "Volume": empty,
+            "Value": empty,
+            "TotalVolume": empty,
+            "TotalValue": empty,
+        })
+
+    # Broadcast each input row to its chunks, spreading Count as evenly as possible
+    row_idx = np.repeat(np.arange(len(df)), splits)
+    local = np.concatenate([np.arange(s) for s in splits])
+    base = counts // splits
+    rem = counts % splits
+    chunk_counts = base[row_idx] + (local < rem[row_idx])
+
+    chunk_vols = vols[row_idx]
+    chunk_vals = vals[row_idx]
+    type_codes = df["Type"].cat.codes.to_numpy()
+    return pd.DataFrame({
+        "Type": pd.Categorical.from_codes(type_codes[row_idx], dtype=df["Type"].dtype),
+        "Count": chunk_counts,
+        "Volume": chunk_vols,
+        "Value": chunk_vals,
+        "TotalVolume": chunk_counts * chunk_vols,
+        "TotalValue": chunk_counts * chunk_vals,
+    })
+
+
+@njit(cache=True)
+def _seg_update(seg, size, pos, val):
+    """Set leaf `pos` of the max segment tree to `val` and rebuild its path."""
+    i = pos + size
+    seg[i] = val
+    i >>= 1
+    while i >= 1:
+        seg[i] = max(seg[2 * i], seg[2 * i + 1])
+        i >>= 1
+
+
+@njit(cache=True)
+def _seg_query_from(seg, size, start, need):
+    """Leftmost leaf index >= start whose value >= need, or -1."""
+    if start >= size:
+        return -1
+    i = start + size
+    if seg[i] >= need:
+        return start
+    while i > 1:
+        if (i & 1) == 0 and seg[i + 1] >= need:
+            i += 1
+            while i < size:  # descend to the leftmost fitting leaf
+                i <<= 1
+                if seg[i] < need:
+                    i += 1
+            return i - size
+        i >>= 1
+    return -1
+
+
+@njit(cache=True)
+def pack_bins(tvols, tvals, order, volume_limit, value_limit):
+    """First-Fit the items in `order` into bins; returns 1-based package ids.
+
+    A max segment tree over each bin's remaining volume answers "first bin
+    with room" in O(log bins); bins that fail the ISK limit are skipped by
+    resuming the query past them.
+    """
+    n = order.shape[0]
+    size = 1
+    while size < n:
+        size <<= 1
+    seg = np.zeros(2 * size)  # unopened slots stay at 0 and never match
+    bin_vol = np.zeros(n)
+    bin_val = np.zeros(n)
+    pkg_of = np.empty(n, np.int64)
+    n_bins = 0
+    prev = -1
+    prev_item = -1
+    for k in range(n):
+        i = order[k]
+        placed = -1
+        # Fast path: consecutive chunks of a split stack are identical, and for
+        # an item equal to the previous one the bin it went into is still the
+        # first fit (no earlier bin has changed since that query), so skipping
+        # the tree lookup cannot alter the packing.
+        if (prev >= 0 and tvols[i] == tvols[prev_item] and tvals[i] == tvals[prev_item]
+                and bin_vol[prev] + tvols[i] <= volume_limit and bin_val[prev] + tvals[i] <= value_limit):
+            placed = prev
+        else:
+            start = 0
+            while True:
+                b = _seg_query_from(seg, size, start, tvols[i])
+                if b < 0:
+                    break
+                if bin_val[b] + tvals[i] <= value_limit:
+                    placed = b
+                    break
+                start = b + 1
+        if placed < 0:
+            placed = n_bins
+            n_bins += 1
+        bin_vol[placed] += tvols[i]
+        bin_val[placed] += tvals[i]
+        _seg_update(seg, size, placed, volume_limit - bin_vol[placed])
+        pkg_of[i] = placed + 1
+        prev = placed
+        prev_item = i
+    return pkg_of
+
+
+@st.cache_data
+def pack_packages(tsv, volume_limit, value_limit, soft_split_limit):
+    """Expand, order, and First-Fit the input; returns the expanded frame plus a Package column."""
+    df_expanded = expand_stacks(tsv, volume_limit, value_limit)
+
+    # Struct-of-arrays view of the expanded chunks; the packer works on indices
+    tvols = df_expanded["TotalVolume"].to_numpy()
+    tvals = df_expanded["TotalValue"].to_numpy()
+
+    # Apply soft penalty to types that exceed the soft split limit
+    type_codes = df_expanded["Type"].cat.codes.to_numpy()
+    split_counts = np.bincount(type_codes)
+    penalty = np.maximum(0, split_counts[type_codes] - soft_split_limit)
+    order = np.argsort(-tvols / (1 + 0.1 * penalty), kind="stable")  # penalize over-split types slightly
+
+    pkg_of = pack_bins(tvols, tvals, order, float(volume_limit), float(value_limit))
+    return df_expanded.assign(Package=pkg_of)
+
+
 # --- Configurable inputs ---
 volume_limit = st.number_input("📦 Max Volume per Package (m³)", 100_000, 1_250_000, 350_000, 50_000)
 value_limit = st.number_input("💰 Max ISK per Package", 1_000_000_000, 50_000_000_000, 10_000_000_000, 500_000_000)
@@ -18,96 +186,51 @@ if not tsv_input.strip():
     st.stop()
 
 try:
-    df = pd.read_csv(StringIO(tsv_input), sep="\t")
+    df = parse_tsv(tsv_input)
     assert {"Type", "Count", "Volume", "Value"}.issubset(df.columns)
 except Exception:
     st.error("Invalid TSV format. Please include Type, Count, Volume, Value.")
     st.stop()
 
-# --- Preprocessing with enforced per-stack ISK limit (max 50% of value_limit) ---
-rows = []
-split_counts = defaultdict(int)
-for _, r in df.iterrows():
-    count = int(r["Count"])
-    unit_vol = float(r["Volume"])
-    unit_val = float(r["Value"])
-    type_name = r["Type"]
-
-    max_stack_value = value_limit / 2
-    max_units_by_isk = math.floor(max_stack_value / unit_val)
-    max_units_by_vol = math.floor(volume_limit / unit_vol)
-    chunk_size = max(1, min(max_units_by_isk, max_units_by_vol))
-
-    for i in range(math.ceil(count / chunk_size)):
-        actual_count = chunk_size if i < math.ceil(count / chunk_size) - 1 else count - chunk_size * (math.ceil(count / chunk_size) - 1)
-        split_counts[type_name] += 1
-        rows.append({
-            "Type": type_name,
-            "Count": actual_count,
-            "Volume": unit_vol,
-            "Value": unit_val,
-            "TotalVolume": actual_count * unit_vol,
-            "TotalValue": actual_count * unit_val
-        })
+# A single unit over either limit can never be packaged; fail before packing
+if (df["Volume"] > volume_limit).any() or (df["Value"] > value_limit).any():
+    st.error("At least one ship exceeds the package limits on its own. Raise the limits or remove it.")
+    st.stop()
+
+# --- Split stacks and pack (cached across reruns) ---
+all_df = pack_packages(tsv_input, volume_limit, value_limit, soft_split_limit)
 
-# --- Apply soft penalty to types that exceed the soft split limit ---
-def penalty_key(item):
-    splits = split_counts[item["Type"]]
-    penalty = max(0, splits - soft_split_limit)
-    return -item["TotalVolume"] / (1 + 0.1 * penalty)  # penalize over-split types slightly
-
-rows.sort(key=penalty_key)
-
-# --- Modified First-Fit Decreasing with ISK & Volume limits ---
-bins = []
-for item in rows:
-    placed = False
-    for b in bins:
-        used_vol = sum(i["TotalVolume"] for i in b)
-        used_val = sum(i["TotalValue"] for i in b)
-        if used_vol + item["TotalVolume"] <= volume_limit and used_val + item["TotalValue"] <= value_limit:
-            b.append(item)
-            placed = True
-            break
-    if not placed:
-        bins.append([item])
-
-# --- Consolidate per package ---
-def consolidate(bin_items):
-    dfp = pd.DataFrame(bin_items)
-    grouped = dfp.groupby("Type").agg({
-        "Count": "sum",
-        "Volume": "first",
-        "Value": "first"
-    }).reset_index()
-    grouped["TotalVolume"] = grouped["Count"] * grouped["Volume"]
-    grouped["TotalValue"] = grouped["Count"] * grouped["Value"]
-    return grouped
+# --- Consolidate all packages with a single groupby ---
+consolidated = all_df.groupby(["Package", "Type"], sort=False, observed=True).agg({
+    "Count": "sum",
+    "Volume": "first",
+    "Value": "first"
+}).reset_index()
+consolidated["TotalVolume"] = consolidated["Count"] * consolidated["Volume"]
+consolidated["TotalValue"] = consolidated["Count"] * consolidated["Value"]
 
 # --- UI Display ---
+package_tables = [(i, grp.drop(columns="Package")) for i, grp in consolidated.groupby("Package")]
+pkg_totals = consolidated.groupby("Package")[["TotalVolume", "TotalValue"]].sum()
 left, right = st.columns([3, 2])
 
+summary = []
 with left:
-    for i, b in enumerate(bins, 1):
-        consolidated = consolidate(b)
-        st.subheader(f"📦 Package {i}")
-        st.write(f"**Volume**: {consolidated.TotalVolume.sum():,.0f} m³")
-        st.write(f"**Value**: {consolidated.TotalValue.sum():,.0f} ISK")
-        st.dataframe(consolidated)
-
-with right:
-    st.subheader("📊 Summary")
-    summary = []
-    for i, b in enumerate(bins, 1):
-        s = consolidate(b)
+    for i, grp in package_tables:
+        volume_str = f"{pkg_totals.at[i, 'TotalVolume']:,.0f}"
+        value_str = f"{pkg_totals.at[i, 'TotalValue']:,.0f}"
+        with st.expander(f"📦 Package {i}", expanded=(i <= 3)):
+            st.write(f"**Volume**: {volume_str} m³")
+            st.write(f"**Value**: {value_str} ISK")
+            st.dataframe(grp)
         summary.append({
             "Package": i,
-            "Volume (m³)": s.TotalVolume.sum(),
-            "Value (ISK)": s.TotalValue.sum(),
-            "Ship Types": len(s),
-            "Total Ships": s["Count"].sum()
+            "Volume (m³)": volume_str,
+            "Value (ISK)": value_str,
+            "Ship Types": len(grp),
+            "Total Ships": grp["Count"].sum()
         })
-    st.dataframe(pd.DataFrame(summary).style.format({
-        "Volume (m³)": "{:,.0f}",
-        "Value (ISK)": "{:,.0f}"
-    }), use_container_width=True)
+
+with right:
+    st.subheader("📊 Summary")
+    st.dataframe(pd.DataFrame(summary), use_container_width=True)